@@ -0,0 +1,43 @@
+# One-time helper that writes reduced-precision copies of the U²-Net model next to the original.
+# Requires 'onnx', 'onnxconverter-common', 'onnxruntime' and 'rembg': pip install onnx onnxconverter-common onnxruntime rembg
+
+import argparse
+import os
+import sys
+
+try:
+    import onnx
+    from onnxconverter_common.float16 import convert_float_to_float16
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from u2net_model import model_path, model_variants
+except ModuleNotFoundError as e:
+    print(f"⚠️ Required module not found: {e.name}. Please install it using: pip install onnx onnxconverter-common onnxruntime rembg")
+    exit()
+
+def default_model():
+    # Start from the slimmed model written by scripts/slim_model.py when it exists.
+    base = model_path()
+    slim_path = model_variants(base)["fp32"]
+    return slim_path if os.path.exists(slim_path) else base
+
+def main():
+    parser = argparse.ArgumentParser(description="Write FP16 and INT8 versions of the U²-Net ONNX model.")
+    parser.add_argument("model", nargs="?", help="defaults to the slimmed, else the original, rembg u2net.onnx")
+    parser.add_argument("--skip-int8", action="store_true", help="only write the FP16 model")
+    args = parser.parse_args()
+    args.model = args.model or default_model()
+
+    stem = os.path.splitext(args.model)[0].removesuffix(".slim")
+    fp16_path = f"{stem}_fp16.onnx"
+    onnx.save(convert_float_to_float16(onnx.load(args.model)), fp16_path)
+    print(f"✅ Wrote {fp16_path}")
+
+    if not args.skip_int8:
+        int8_path = f"{stem}_int8.onnx"
+        quantize_dynamic(args.model, int8_path, weight_type=QuantType.QUInt8)
+        print(f"✅ Wrote {int8_path}")
+
+if __name__ == "__main__":
+    main()
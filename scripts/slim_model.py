@@ -0,0 +1,52 @@
+# One-time helper that strips redundant nodes from the U²-Net model with onnxslim and checks the masks still match.
+# Requires 'onnx', 'onnxslim', 'onnxruntime', 'rembg', 'numpy' and 'pillow': pip install onnx onnxslim onnxruntime rembg numpy pillow
+
+import argparse
+import os
+import sys
+
+try:
+    import numpy as np
+    import onnx
+    import onnxruntime as ort
+    from onnxslim import slim
+    from PIL import Image
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from u2net_model import model_path, preprocess, run_session
+except ModuleNotFoundError as e:
+    print(f"⚠️ Required module not found: {e.name}. Please install it using: pip install onnx onnxslim onnxruntime rembg numpy pillow")
+    exit()
+
+def masks_for(path, batch):
+    sess = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+    preds = run_session(sess, batch)[:, 0].astype(np.float32)
+    mins = preds.min(axis=(1, 2), keepdims=True)
+    maxs = preds.max(axis=(1, 2), keepdims=True)
+    return (preds - mins) / np.maximum(maxs - mins, 1e-6)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a slimmed copy of the U²-Net ONNX model.")
+    parser.add_argument("model", nargs="?", help="defaults to rembg's u2net.onnx, downloading it if needed")
+    parser.add_argument("--check", nargs="*", default=[], metavar="IMAGE",
+                        help="images whose masks must match between the original and slimmed model")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="largest allowed per-pixel mask difference")
+    args = parser.parse_args()
+    args.model = args.model or model_path()
+
+    slim_path = f"{os.path.splitext(args.model)[0]}.slim.onnx"
+    onnx.save(slim(args.model), slim_path)
+    print(f"✅ Wrote {slim_path}")
+
+    if args.check:
+        batch = np.stack([preprocess(Image.open(p)) for p in args.check]).astype(np.float32)
+        diff = np.abs(masks_for(args.model, batch) - masks_for(slim_path, batch)).max(axis=(1, 2))
+        for path, d in zip(args.check, diff):
+            print(f"{'✅' if d <= args.tolerance else '❌'} {path}: max mask difference {d:.2e}")
+        if (diff > args.tolerance).any():
+            os.remove(slim_path)
+            print(f"⚠️ Masks differ beyond {args.tolerance}; removed {slim_path}")
+            exit(1)
+
+if __name__ == "__main__":
+    main()
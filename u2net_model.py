@@ -0,0 +1,40 @@
+# U²-Net model files and tensor helpers shared by app5bg.py and the scripts in scripts/.
+
+import os
+
+import numpy as np
+from PIL import Image
+from rembg.sessions.u2net import U2netSession
+
+MODEL_SIZE = (320, 320)
+MODEL_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+MODEL_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+def model_path():
+    # rembg downloads the model on first use and returns wherever it actually keeps it.
+    return U2netSession.download_models()
+
+def model_variants(path):
+    # Slimmed copy written by scripts/slim_model.py, and reduced-precision copies written by
+    # scripts/quantize_model.py, all stored next to rembg's u2net.onnx.
+    stem = os.path.splitext(path)[0]
+    return {
+        "fp32": f"{stem}.slim.onnx",
+        "fp16": f"{stem}_fp16.onnx",
+        "int8": f"{stem}_int8.onnx",
+    }
+
+def preprocess(image):
+    im = np.asarray(image.convert("RGB").resize(MODEL_SIZE, Image.Resampling.LANCZOS), dtype=np.float32)
+    im = im / max(float(im.max()), 1e-6)
+    im = (im - MODEL_MEAN) / MODEL_STD
+    return im.transpose(2, 0, 1)
+
+def run_session(sess, batch):
+    inp = sess.get_inputs()[0]
+    if inp.type == "tensor(float16)":
+        batch = batch.astype(np.float16)
+    # Models exported with a fixed batch dimension can only take one image per run.
+    if isinstance(inp.shape[0], int) and inp.shape[0] != len(batch):
+        return np.concatenate([sess.run(None, {inp.name: batch[i:i + 1]})[0] for i in range(len(batch))])
+    return sess.run(None, {inp.name: batch})[0]